@@ -1,6 +1,12 @@
+import logging
+import selectors
+import socket
 import threading
+import time
 from socketserver import TCPServer, ThreadingMixIn
 
+logger = logging.getLogger('judge.bridge')
+
 
 class ThreadingTCPListener(ThreadingMixIn, TCPServer):
     allow_reuse_address = True
@@ -28,3 +34,105 @@ class Server:
         for server in self.servers:
             server.shutdown()
         self._shutdown.set()
+
+
+# Serves every listener and connection from the thread calling serve_forever(),
+# instead of one thread per connection. Readable connections are handed to the
+# handler's read_ready(), so `handler` must be a ZlibPacketHandler subclass.
+class SelectorServer(Server):
+    def __init__(self, addresses, handler):
+        super().__init__(addresses, handler)
+        self.handler = handler
+        self._selector = selectors.DefaultSelector()
+        self._wakeup, self._waker = socket.socketpair()
+        self._last_activity = {}
+
+    def serve_forever(self, poll_interval=1):
+        selector = self._selector
+        for server in self.servers:
+            selector.register(server.socket, selectors.EVENT_READ, server)
+        selector.register(self._wakeup, selectors.EVENT_READ)
+
+        next_sweep = time.monotonic() + poll_interval
+        try:
+            while not self._shutdown.is_set():
+                for key, _ in selector.select(poll_interval):
+                    if isinstance(key.data, TCPServer):
+                        self._accept(key.data)
+                    elif key.data is not None:
+                        self._read(key.data)
+                    else:
+                        self._wakeup.recv(4096)
+
+                now = time.monotonic()
+                if now >= next_sweep:
+                    self._expire_idle(now)
+                    next_sweep = now + poll_interval
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for handler in list(self._last_activity):
+                self._finish(handler)
+            for server in self.servers:
+                selector.unregister(server.socket)
+                server.server_close()
+            selector.close()
+            self._wakeup.close()
+            self._waker.close()
+
+    def shutdown(self):
+        self._shutdown.set()
+        try:
+            self._waker.send(b'\0')
+        except OSError:
+            pass
+
+    def _accept(self, server):
+        try:
+            request, client_address = server.get_request()
+        except OSError:
+            return
+
+        try:
+            handler = self.handler.attach(request, client_address, server)
+        except Exception:
+            logger.exception('Error while accepting judge connection')
+            server.shutdown_request(request)
+            return
+
+        self._last_activity[handler] = time.monotonic()
+        self._selector.register(request, selectors.EVENT_READ, handler)
+
+    # A failure in one connection must only drop that connection, not the loop serving every judge.
+    def _read(self, handler):
+        try:
+            alive = handler.read_ready()
+        except Exception:
+            logger.exception('Error in judge packet handling')
+            alive = False
+
+        if alive:
+            self._last_activity[handler] = time.monotonic()
+        else:
+            self._finish(handler)
+
+    def _expire_idle(self, now):
+        for handler, last in list(self._last_activity.items()):
+            timeout = handler.timeout
+            if timeout is not None and now - last > timeout:
+                try:
+                    handler.handle_timeout()
+                except Exception:
+                    logger.exception('Error in judge timeout handling')
+                self._finish(handler)
+
+    def _finish(self, handler):
+        del self._last_activity[handler]
+        self._selector.unregister(handler.request)
+        try:
+            handler.on_cleanup()
+            handler.on_disconnect()
+        except Exception:
+            logger.exception('Error while cleaning up judge connection')
+        finally:
+            handler.server.shutdown_request(handler.request)
@@ -1,12 +1,14 @@
 import logging
+import select
 import socket
 import struct
+import threading
 import zlib
 from itertools import chain
 
 from netaddr import IPGlob, IPSet
 
-from .unicode import utf8text
+from .unicode import utf8bytes, utf8text
 
 logger = logging.getLogger('judge.bridge')
 
@@ -14,6 +16,7 @@ size_pack = struct.Struct('!I')
 assert size_pack.size == 4
 
 MAX_ALLOWED_PACKET_SIZE = 8 * 1024 * 1024
+RECV_SIZE = 64 * 1024
 
 
 def proxy_list(human_readable):
@@ -48,9 +51,19 @@ class RequestHandlerMeta(type):
         finally:
             handler.on_disconnect()
 
+    # For event loops that feed the handler through read_ready() instead of
+    # running the blocking handle() on a thread of its own.
+    def attach(cls, *args, **kwargs):
+        handler = super().__call__(*args, **kwargs)
+        handler.on_connect()
+        return handler
+
 
 class ZlibPacketHandler(metaclass=RequestHandlerMeta):
-    proxies = []
+    __slots__ = ('request', 'server', 'client_address', 'server_address', '_initial_tag', '_got_packet',
+                 '_send_lock', '_recv_buf', '_proxy_pending')
+
+    proxies = frozenset()
 
     def __init__(self, request, client_address, server):
         self.request = request
@@ -59,6 +72,9 @@ class ZlibPacketHandler(metaclass=RequestHandlerMeta):
         self.server_address = server.server_address
         self._initial_tag = None
         self._got_packet = False
+        self._send_lock = threading.Lock()
+        self._recv_buf = bytearray()
+        self._proxy_pending = False
 
     @property
     def timeout(self):
@@ -68,25 +84,31 @@ class ZlibPacketHandler(metaclass=RequestHandlerMeta):
     def timeout(self, timeout):
         self.request.settimeout(timeout or None)
 
-    def read_sized_packet(self, size, initial=None):
+    def check_packet_size(self, size):
         if size > MAX_ALLOWED_PACKET_SIZE:
             logger.log(logging.WARNING if self._got_packet else logging.INFO,
                        'Disconnecting client due to too-large message size (%d bytes): %s', size, self.client_address)
             raise Disconnect()
 
-        buffer = []
-        remainder = size
+    def read_sized_packet(self, size, initial=None):
+        self.check_packet_size(size)
 
-        if initial:
-            buffer.append(initial)
-            remainder -= len(initial)
-            assert remainder >= 0
+        # Receive straight into one preallocated buffer instead of joining a list of chunks.
+        buffer = bytearray(size)
+        received = 0
 
-        while remainder:
-            data = self.request.recv(remainder)
-            remainder -= len(data)
-            buffer.append(data)
-        self._on_packet(b''.join(buffer))
+        if initial:
+            received = len(initial)
+            assert received <= size
+            buffer[:received] = initial
+
+        with memoryview(buffer) as view:
+            while received < size:
+                count = self.request.recv_into(view[received:], size - received)
+                if not count:
+                    raise Disconnect()
+                received += count
+        self._on_packet(buffer)
 
     def parse_proxy_protocol(self, line):
         words = line.split()
@@ -125,7 +147,8 @@ class ZlibPacketHandler(metaclass=RequestHandlerMeta):
         return buffer
 
     def _on_packet(self, data):
-        decompressed = zlib.decompress(data).decode('utf-8')
+        # Handed over undecoded: JSON parsers read UTF-8 bytes directly, so decoding here would only add a copy.
+        decompressed = zlib.decompress(data)
         self._got_packet = True
         self.on_packet(decompressed)
 
@@ -148,7 +171,7 @@ class ZlibPacketHandler(metaclass=RequestHandlerMeta):
         try:
             tag = self.read_size()
             self._initial_tag = size_pack.pack(tag)
-            if self.client_address[0] in self.proxies and self._initial_tag == b'PROX':
+            if self._initial_tag == b'PROX' and self.client_address[0] in self.proxies:
                 proxy, _, remainder = self.read_proxy_header(self._initial_tag).partition(b'\r\n')
                 self.parse_proxy_protocol(proxy)
 
@@ -173,18 +196,9 @@ class ZlibPacketHandler(metaclass=RequestHandlerMeta):
         except Disconnect:
             return
         except zlib.error:
-            if self._got_packet:
-                logger.warning('Encountered zlib error during packet handling, disconnecting client: %s',
-                               self.client_address, exc_info=True)
-            else:
-                logger.info('Potentially wrong protocol (zlib error): %s: %r', self.client_address, self._initial_tag,
-                            exc_info=True)
+            self._log_zlib_error()
         except socket.timeout:
-            if self._got_packet:
-                logger.info('Socket timed out: %s', self.client_address)
-                self.on_timeout()
-            else:
-                logger.info('Potentially wrong protocol: %s: %r', self.client_address, self._initial_tag)
+            self.handle_timeout()
         except socket.error as e:
             # When a gevent socket is shutdown, gevent cancels all waits, causing recv to raise cancel_wait_ex.
             if e.__class__.__name__ == 'cancel_wait_ex':
@@ -193,9 +207,100 @@ class ZlibPacketHandler(metaclass=RequestHandlerMeta):
         finally:
             self.on_cleanup()
 
+    def _log_zlib_error(self):
+        if self._got_packet:
+            logger.warning('Encountered zlib error during packet handling, disconnecting client: %s',
+                           self.client_address, exc_info=True)
+        else:
+            logger.info('Potentially wrong protocol (zlib error): %s: %r', self.client_address, self._initial_tag,
+                        exc_info=True)
+
+    def handle_timeout(self):
+        if self._got_packet:
+            logger.info('Socket timed out: %s', self.client_address)
+            self.on_timeout()
+        else:
+            logger.info('Potentially wrong protocol: %s: %r', self.client_address, self._initial_tag)
+
+    # Non-blocking counterpart of handle(), called by an event loop when the
+    # socket is readable. Returns False once the connection should be dropped;
+    # the caller is then responsible for on_cleanup() and on_disconnect().
+    def read_ready(self):
+        try:
+            data = self.request.recv(RECV_SIZE)
+            if not data:
+                raise Disconnect()
+            self.feed(data)
+        except Disconnect:
+            return False
+        except zlib.error:
+            self._log_zlib_error()
+            return False
+        except socket.error as e:
+            if e.__class__.__name__ != 'cancel_wait_ex':
+                logger.exception('Error in base packet handling')
+            return False
+        return True
+
+    def feed(self, data):
+        buffer = self._recv_buf
+        buffer += data
+
+        if self._initial_tag is None:
+            if len(buffer) < size_pack.size:
+                return
+            self._initial_tag = bytes(buffer[:size_pack.size])
+            self._proxy_pending = self._initial_tag == b'PROX' and self.client_address[0] in self.proxies
+
+        if self._proxy_pending:
+            end = buffer.find(b'\r\n')
+            if end < 0:
+                # Max line length for PROXY protocol is 107.
+                if len(buffer) > 107:
+                    raise Disconnect()
+                return
+            self.parse_proxy_protocol(bytes(buffer[:end]))
+            del buffer[:end + 2]
+            self._proxy_pending = False
+
+        offset = 0
+        with memoryview(buffer) as view:
+            while len(buffer) - offset >= size_pack.size:
+                size = size_pack.unpack_from(buffer, offset)[0]
+                self.check_packet_size(size)
+                start = offset + size_pack.size
+                if len(buffer) - start < size:
+                    break
+                offset = start + size
+                self._on_packet(view[start:offset])
+        del buffer[:offset]
+
     def send(self, data):
-        compressed = zlib.compress(data.encode('utf-8'))
-        self.request.sendall(size_pack.pack(len(compressed)) + compressed)
+        self.send_bytes(utf8bytes(data))
+
+    def send_bytes(self, data):
+        # Every packet must stay a complete zlib stream, since the judge decompresses each one on its own.
+        compressed = zlib.compress(data)
+        packet = size_pack.pack(len(compressed)) + compressed
+
+        # Packets can be sent from several threads, e.g. pings from the deadline thread, so keep them from
+        # interleaving on the socket.
+        with self._send_lock:
+            self.request.sendall(packet)
+
+    # Sends a small packet only if that cannot block: returns False instead of waiting when another send holds
+    # the socket or the peer is not reading. Meant for droppable packets sent from shared threads, like pings.
+    def send_bytes_nowait(self, data):
+        if not self._send_lock.acquire(blocking=False):
+            return False
+        try:
+            if not select.select((), (self.request,), (), 0)[1]:
+                return False
+            compressed = zlib.compress(data)
+            self.request.sendall(size_pack.pack(len(compressed)) + compressed)
+            return True
+        finally:
+            self._send_lock.release()
 
     def close(self):
         self.request.shutdown(socket.SHUT_RDWR)
@@ -0,0 +1,66 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger('judge.bridge')
+
+
+# Runs callbacks at time.monotonic() deadlines from a single shared thread,
+# instead of starting a threading.Timer for every deadline. Cancellation is
+# lazy: cancel() clears the callback and the entry is dropped once it reaches
+# the top of the heap.
+class DeadlineHeap:
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def arm(self, deadline, callback):
+        with self._lock:
+            token = next(self._counter)
+            entry = [deadline, token, callback]
+            self._entries[token] = entry
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='judge-deadlines', daemon=True)
+                self._thread.start()
+            elif self._heap[0] is entry:
+                self._wakeup.set()
+        return token
+
+    def cancel(self, token):
+        with self._lock:
+            entry = self._entries.pop(token, None)
+            if entry is not None:
+                entry[2] = None
+
+    def _pop_due(self):
+        with self._lock:
+            self._wakeup.clear()
+            now = time.monotonic()
+            due = []
+            while self._heap:
+                deadline, token, callback = self._heap[0]
+                if callback is not None and deadline > now:
+                    return due, deadline - now
+                heapq.heappop(self._heap)
+                if callback is not None:
+                    del self._entries[token]
+                    due.append(callback)
+            return due, None
+
+    def _run(self):
+        while True:
+            due, timeout = self._pop_due()
+            for callback in due:
+                try:
+                    callback()
+                except Exception:
+                    logger.exception('Error in deadline callback: %r', callback)
+            if not due:
+                self._wakeup.wait(timeout)
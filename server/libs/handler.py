@@ -1,10 +1,20 @@
 import json
 import logging
+import sys
 import threading
 import time
 from collections import deque, namedtuple
+from types import MappingProxyType
+from typing import Callable, ClassVar, Mapping
 
 from .base_handler import ZlibPacketHandler, proxy_list
+from .deadline import DeadlineHeap
+from .unicode import utf8bytes, utf8text
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger('judge.bridge')
 json_log = logging.getLogger('judge.json.bridge')
@@ -13,27 +23,87 @@ UPDATE_RATE_LIMIT = 5
 UPDATE_RATE_TIME = 0.5
 SubmissionData = namedtuple('SubmissionData', 'time memory short_circuit pretests_only contest_no attempt_no user_id')
 
+NO_RESPONSE_TIMEOUT = 20
+PING_INTERVAL = 10
+MALFORMED_LOG_BYTES = 120
+_WATCHDOG = DeadlineHeap()
+
+
+# Mean over the last `size` samples, maintaining the sum as samples enter and leave the window.
+class _RunningMean:
+    __slots__ = ('_samples', '_size', 'sum')
+
+    def __init__(self, size):
+        self._samples = deque()
+        self._size = size
+        self.sum = 0.0
+
+    def add(self, value):
+        if len(self._samples) == self._size:
+            self.sum -= self._samples.popleft()
+        self._samples.append(value)
+        self.sum += value
+
+    def mean(self):
+        return self.sum / len(self._samples)
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+# orjson emits compact JSON as bytes, which ZlibPacketHandler.send can compress directly. Anything orjson
+# refuses but json accepts (namedtuples, ints over 64 bits, ...) goes through json, so both backends take the
+# same inputs. The one remaining difference: orjson writes NaN and infinities as null.
+if orjson is not None:
+    def _dumps(obj):
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return _json_dumps(obj)
+
+    _loads = orjson.loads
+else:
+    _dumps = _json_dumps
+    _loads = json.loads
+
+# Packets with a fixed body are serialized once, and sent through ZlibPacketHandler.send_bytes.
+_HANDSHAKE_OK = b'{"name":"handshake-success"}'
+_DISCONNECT = b'{"name":"disconnect"}'
+_ABORT = b'{"name":"terminate-submission"}'
+_PING = b'{"name":"ping","when":%f}'
+_SUBMIT = (b'{"name":"submission-request","submission-id":%s,"problem-id":%s,"language":%s,"source":%s,'
+           b'"time-limit":%s,"memory-limit":%s,"short-circuit":%s,'
+           b'"meta":{"pretests-only":%s,"in-contest":%s,"attempt-no":%s,"user":%s}}')
+
+
+def _json_value(obj):
+    return utf8bytes(_dumps(obj))
+
+
+# Encoded only when a log handler formats the record, which happens on the log listener thread. Call sites
+# also check json_log.isEnabledFor() first, so nothing is built at all while the logger is silenced.
+class _JsonLogMessage:
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return utf8text(_dumps(self.data))
+
 
 class JudgeHandler(ZlibPacketHandler):
+    # `timeout` is a property on ZlibPacketHandler, so it is not a slot.
+    __slots__ = ('_working', '_no_response_job', '_problems', 'executors', 'problems', 'latency', 'time_delta',
+                 'load', 'name', 'is_disabled', 'tier', 'batch_id', 'in_batch', '_ping_lock', '_ping_job',
+                 '_ping_average', '_time_delta', 'update_counter', 'judge', 'judge_address',
+                 '_submission_cache_id', '_submission_cache')
+
     proxies = proxy_list([])
 
     def __init__(self, request, client_address, server):
         super().__init__(request, client_address, server)
-        self.handlers = {
-            'grading-begin': self.on_grading_begin,
-            'grading-end': self.on_grading_end,
-            'compile-error': self.on_compile_error,
-            'compile-message': self.on_compile_message,
-            'batch-begin': self.on_batch_begin,
-            'batch-end': self.on_batch_end,
-            'test-case-status': self.on_test_case,
-            'internal-error': self.on_internal_error,
-            'submission-terminated': self.on_submission_terminated,
-            'submission-acknowledged': self.on_submission_acknowledged,
-            'ping-response': self.on_ping_response,
-            'supported-problems': self.on_supported_problems,
-            'handshake': self.on_handshake,
-        }
         self._working = False
         self._no_response_job = None
         self._problems = []
@@ -47,9 +117,10 @@ class JudgeHandler(ZlibPacketHandler):
         self.tier = None
         self.batch_id = None
         self.in_batch = False
-        self._stop_ping = threading.Event()
-        self._ping_average = deque(maxlen=6)  # 1 minute average, just like load
-        self._time_delta = deque(maxlen=6)
+        self._ping_lock = threading.Lock()
+        self._ping_job = None
+        self._ping_average = _RunningMean(6)  # 1 minute average, just like load
+        self._time_delta = _RunningMean(6)
 
         # each value is (updates, last reset)
         self.update_counter = {}
@@ -62,17 +133,25 @@ class JudgeHandler(ZlibPacketHandler):
     def on_connect(self):
         self.timeout = 15
         logger.info('Judge connected from: %s', self.client_address)
-        json_log.info(self._make_json_log(action='connect'))
+        if json_log.isEnabledFor(logging.INFO):
+            json_log.info(self._make_json_log(action='connect'))
 
     def on_disconnect(self):
-        self._stop_ping.set()
+        with self._ping_lock:
+            if self._ping_job is not None:
+                _WATCHDOG.cancel(self._ping_job)
+                self._ping_job = None
+        if self._no_response_job is not None:
+            _WATCHDOG.cancel(self._no_response_job)
+            self._no_response_job = None
         if self._working:
             logger.error('Judge %s disconnected while handling submission %s', self.name, self._working)
         if self.name is not None:
             self._disconnected()
         logger.info('Judge disconnected from: %s with name %s', self.client_address, self.name)
 
-        json_log.info(self._make_json_log(action='disconnect', info='judge disconnected'))
+        if json_log.isEnabledFor(logging.INFO):
+            json_log.info(self._make_json_log(action='disconnect', info='judge disconnected'))
 
     def _authenticate(self, id, key):
         # TODO: Implement a better way to authenticate judges
@@ -91,7 +170,7 @@ class JudgeHandler(ZlibPacketHandler):
         pass
 
     def send(self, data):
-        super().send(json.dumps(data, separators=(',', ':')))
+        super().send(_dumps(data))
 
     def on_handshake(self, packet):
         if 'id' not in packet or 'key' not in packet:
@@ -105,13 +184,15 @@ class JudgeHandler(ZlibPacketHandler):
 
         self.timeout = 60
         self._problems = packet['problems']
-        self.problems = dict(self._problems)
-        self.executors = packet['executors']
+        # Intern the keys so that every judge shares one string object per problem and executor name.
+        self.problems = {sys.intern(code): timestamp for code, timestamp in self._problems}
+        self.executors = {sys.intern(name): versions for name, versions in packet['executors'].items()}
         self.name = packet['id']
 
-        self.send({'name': 'handshake-success'})
+        self.send_bytes(_HANDSHAKE_OK)
         logger.info('Judge authenticated: %s (%s)', self.client_address, packet['id'])
-        threading.Thread(target=self._ping_thread).start()
+        with self._ping_lock:
+            self._ping_job = _WATCHDOG.arm(time.monotonic(), self._ping_tick)
         self._connected()
 
     def can_judge(self, problem, executor, judge_id=None):
@@ -131,30 +212,21 @@ class JudgeHandler(ZlibPacketHandler):
             # Yank the power out.
             self.close()
         else:
-            self.send({'name': 'disconnect'})
+            self.send_bytes(_DISCONNECT)
 
     def submit(self, id, problem, language, source):
         data = self.get_related_submission_data(id)
         self._working = id
-        self._no_response_job = threading.Timer(20, self._kill_if_no_response)
-        self.send({
-            'name': 'submission-request',
-            'submission-id': id,
-            'problem-id': problem,
-            'language': language,
-            'source': source,
-            'time-limit': data.time,
-            'memory-limit': data.memory,
-            'short-circuit': data.short_circuit,
-            'meta': {
-                'pretests-only': data.pretests_only,
-                'in-contest': data.contest_no,
-                'attempt-no': data.attempt_no,
-                'user': data.user_id,
-            },
-        })
+        self._no_response_job = _WATCHDOG.arm(time.monotonic() + NO_RESPONSE_TIMEOUT, self._kill_if_no_response)
+        self.send_bytes(_SUBMIT % (
+            _json_value(id), _json_value(problem), _json_value(language), _json_value(source),
+            _json_value(data.time), _json_value(data.memory), _json_value(data.short_circuit),
+            _json_value(data.pretests_only), _json_value(data.contest_no), _json_value(data.attempt_no),
+            _json_value(data.user_id),
+        ))
 
     def _kill_if_no_response(self):
+        self._no_response_job = None
         logger.error('Judge failed to acknowledge submission: %s: %s', self.name, self._working)
         self.close()
 
@@ -169,28 +241,31 @@ class JudgeHandler(ZlibPacketHandler):
         pass
 
     def on_submission_acknowledged(self, packet):
-        pass
+        if self._no_response_job is not None:
+            _WATCHDOG.cancel(self._no_response_job)
+            self._no_response_job = None
 
     def abort(self):
-        self.send({'name': 'terminate-submission'})
+        self.send_bytes(_ABORT)
 
     def get_current_submission(self):
         return self._working or None
 
     def ping(self):
-        self.send({'name': 'ping', 'when': time.time()})
+        # Runs on the shared deadline thread, so a judge that is busy or not reading only misses this ping.
+        return self.send_bytes_nowait(_PING % time.time())
 
     def on_packet(self, data):
         try:
             try:
-                data = json.loads(data)
-                if 'name' not in data:
-                    raise ValueError
-            except ValueError:
+                data = _loads(data)
+                name = data['name']
+            except (ValueError, KeyError, TypeError):
+                # Not JSON, not an object, or no name.
                 self.on_malformed(data)
             else:
-                handler = self.handlers.get(data['name'], self.on_malformed)
-                handler(data)
+                cls = type(self)
+                cls._HANDLERS.get(name, cls.on_malformed)(self, data)
         except Exception:
             logger.exception('Error in packet handling (Judge-side): %s', self.name)
             self._packet_exception()
@@ -198,7 +273,8 @@ class JudgeHandler(ZlibPacketHandler):
             # not being malicious or simply malformed. THIS IS A SERVER!
 
     def _packet_exception(self):
-        json_log.exception(self._make_json_log(sub=self._working, info='packet processing exception'))
+        if json_log.isEnabledFor(logging.ERROR):
+            json_log.exception(self._make_json_log(sub=self._working, info='packet processing exception'))
 
     def _submission_is_batch(self, id):
         # TODO: Return is the submission is a batch
@@ -239,28 +315,49 @@ class JudgeHandler(ZlibPacketHandler):
         pass
 
     def on_malformed(self, packet):
+        if isinstance(packet, bytes):
+            # Raw packets can be up to MAX_ALLOWED_PACKET_SIZE; only log the start.
+            packet = packet[:MALFORMED_LOG_BYTES]
         logger.error('%s: Malformed packet: %s', self.name, packet)
-        json_log.exception(self._make_json_log(sub=self._working, info='malformed json packet'))
+        if json_log.isEnabledFor(logging.ERROR):
+            json_log.exception(self._make_json_log(sub=self._working, info='malformed json packet'))
 
     def on_ping_response(self, packet):
+        # The judge reports its wall clock in 'time', so 'when' has to stay on time.time() as well.
         end = time.time()
-        self._ping_average.append(end - packet['when'])
-        self._time_delta.append((end + packet['when']) / 2 - packet['time'])
-        self.latency = sum(self._ping_average) / len(self._ping_average)
-        self.time_delta = sum(self._time_delta) / len(self._time_delta)
+        when = packet['when']
+        self._ping_average.add(end - when)
+        self._time_delta.add((end + when) / 2 - packet['time'])
+        self.latency = self._ping_average.mean()
+        self.time_delta = self._time_delta.mean()
         self.load = packet['load']
         self._update_ping()
 
-    def _ping_thread(self):
+    def _ping_tick(self):
+        # _ping_lock only guards _ping_job; it is never held across socket I/O.
+        with self._ping_lock:
+            if self._ping_job is None:
+                return
+
         try:
-            while True:
-                self.ping()
-                if self._stop_ping.wait(10):
-                    break
+            if not self.ping():
+                logger.debug('Skipped ping to busy judge: %s', self.name)
         except Exception:
+            with self._ping_lock:
+                if self._ping_job is None:
+                    return
+                self._ping_job = None
             logger.exception('Ping error in %s', self.name)
-            self.close()
-            raise
+            try:
+                self.close()
+            except OSError:
+                # Already closed from the server side.
+                pass
+            return
+
+        with self._ping_lock:
+            if self._ping_job is not None:
+                self._ping_job = _WATCHDOG.arm(time.monotonic() + PING_INTERVAL, self._ping_tick)
 
     def _make_json_log(self, packet=None, sub=None, **kwargs):
         data = {
@@ -272,10 +369,42 @@ class JudgeHandler(ZlibPacketHandler):
         if sub is not None:
             data['submission'] = sub
         data.update(kwargs)
-        return json.dumps(data)
+        return _JsonLogMessage(data)
 
     def _post_update_submission(self, id, state, done=False):
         pass
 
     def on_cleanup(self):
         pass
+
+    # Packet name -> handler method name. Resolved into _HANDLERS once per class, so that subclass overrides
+    # are picked up without building a dict of bound methods for every connection.
+    _PACKET_HANDLERS: ClassVar[Mapping[str, str]] = {
+        'grading-begin': 'on_grading_begin',
+        'grading-end': 'on_grading_end',
+        'compile-error': 'on_compile_error',
+        'compile-message': 'on_compile_message',
+        'batch-begin': 'on_batch_begin',
+        'batch-end': 'on_batch_end',
+        'test-case-status': 'on_test_case',
+        'internal-error': 'on_internal_error',
+        'submission-terminated': 'on_submission_terminated',
+        'submission-acknowledged': 'on_submission_acknowledged',
+        'ping-response': 'on_ping_response',
+        'supported-problems': 'on_supported_problems',
+        'handshake': 'on_handshake',
+    }
+    _HANDLERS: ClassVar[Mapping[str, Callable]]
+
+    @classmethod
+    def _resolve_handlers(cls):
+        cls._HANDLERS = MappingProxyType({
+            sys.intern(name): getattr(cls, method) for name, method in cls._PACKET_HANDLERS.items()
+        })
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._resolve_handlers()
+
+
+JudgeHandler._resolve_handlers()
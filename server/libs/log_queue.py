@@ -0,0 +1,29 @@
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+
+# QueueHandler.prepare() formats the record on the calling thread. The queue
+# never leaves this process, so hand the record over untouched and let the
+# listener thread pay for formatting instead.
+class DeferredQueueHandler(QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+# Moves the handlers configured on `logger` itself behind a queue, so that
+# logging from a judge's socket thread is only a queue put. Propagation is left
+# as configured: handlers on parent loggers still run on the calling thread.
+# Returns the started listener, or None if the logger has no handlers of its own.
+def start_queue_listener(logger):
+    handlers = list(logger.handlers)
+    if not handlers:
+        return None
+
+    log_queue = queue.SimpleQueue()
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(DeferredQueueHandler(log_queue))
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
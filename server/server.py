@@ -1,22 +1,46 @@
-from functools import partial
+import signal
 import threading
 import logging
 
-from .libs.handler import JudgeHandler
-from .libs.ServerModel import Server
+from .libs.handler import JudgeHandler, json_log
+from .libs.log_queue import start_queue_listener
+from .libs.ServerModel import SelectorServer
+
+SHUTDOWN_SIGNALS = {signal.SIGINT, signal.SIGTERM}
+
+if hasattr(signal, 'sigwait'):
+    # Block the shutdown signals before any thread starts, so that every thread
+    # inherits the mask and the signals are only picked up by sigwait() below.
+    signal.pthread_sigmask(signal.SIG_BLOCK, SHUTDOWN_SIGNALS)
+
+    def wait_for_shutdown():
+        signal.sigwait(SHUTDOWN_SIGNALS)
+else:
+    # No sigwait() on Windows: set an event from regular signal handlers. The
+    # wait polls, since a blocking Event.wait() is not interrupted by signals there.
+    shutdown_requested = threading.Event()
+    for signum in SHUTDOWN_SIGNALS:
+        signal.signal(signum, lambda signum, frame: shutdown_requested.set())
+
+    def wait_for_shutdown():
+        while not shutdown_requested.wait(1):
+            pass
 
 # Configure logging
 logger = logging.getLogger('judge.bridge')
+json_log_listener = start_queue_listener(json_log)
 
 # Server setup
-judge_server = Server([("", 9999)], partial(JudgeHandler))
+judge_server = SelectorServer([("", 9999)], JudgeHandler)
 
-threading.Thread(target=judge_server.serve_forever).start()
+server_thread = threading.Thread(target=judge_server.serve_forever, daemon=True)
+server_thread.start()
 
-print('Judge server started, press 1 to exit.')
+print('Judge server started, press Ctrl+C or send SIGTERM to exit.')
 
-while True:
-    if input() == '1':
-        judge_server.shutdown()
-        print('Judge server stopped.')
-        break
\ No newline at end of file
+wait_for_shutdown()
+judge_server.shutdown()
+server_thread.join()
+if json_log_listener is not None:
+    json_log_listener.stop()
+print('Judge server stopped.')